@@ -27,6 +27,10 @@ There are 3 supported model configurations:
 | medium | 39     | 48.45 |  86.16 |  82.07
 | large  | 55     | 37.87 |  82.62 |  78.29
 The exact results may vary depending on the random initialization.
+These results are for a model trained with the full softmax. When num_sampled
+is set, training reports the average per-word sampled loss instead of a train
+perplexity; it is not a perplexity and cannot be compared with the valid and
+test columns, which always use the full softmax.
 
 The hyperparameters used in the model:
 - init_scale - the initial scale of the weights
@@ -40,6 +44,9 @@ The hyperparameters used in the model:
 - keep_prob - the probability of keeping weights in the dropout layer
 - lr_decay - the decay of the learning rate for each epoch after "max_epoch"
 - batch_size - the batch size
+- vocab_size - the number of words; PTBModel pads it to a multiple of 8
+- num_sampled - the number of words sampled for the training softmax
+  (0 uses the full softmax)
 
 The data required for this example is in the data/ dir of the
 PTB dataset from Tomas Mikolov's webpage:
@@ -64,7 +71,6 @@ import tensorflow as tf
 import sys
 import os
 import json
-import random
 sys.path.insert(0, os.path.abspath('..'))
 from code import reader
 
@@ -77,84 +83,167 @@ flags.DEFINE_string(
 flags.DEFINE_string("data_path", None, "data_path")
 flags.DEFINE_string("generate", False, "Whether or not to emit new sentence")
 flags.DEFINE_string("model_path_prefix", None, "model_path_prefix")
+flags.DEFINE_bool("use_fp16", False,
+                  "Compute the full softmax projection in 16-bit floats "
+                  "(weights are still stored as 32-bit floats). Only worth "
+                  "enabling on an fp16-capable GPU with a config that trains "
+                  "with num_sampled = 0; it has no effect on training with "
+                  "the shipped configs")
 FLAGS = flags.FLAGS
 
 
+def data_type():
+  # Every run with --use_fp16 casts the whole float32 embedding to float16
+  # before the projection. That extra read and write only pays off when the
+  # GEMM is large (training batches on a GPU). For batch-1 evaluation and
+  # generation, or on the CPU-only example image, it adds memory traffic.
+  return tf.float16 if FLAGS.use_fp16 else tf.float32
+
+
+def padded_vocab_size(vocab_size):
+  """Rounds vocab_size up to a multiple of 8.
+
+  The embedding and softmax GEMMs only map onto half-precision tensor cores
+  when their dimensions are multiples of 8. PTBModel slices the extra columns
+  off the logits and never samples the extra ids, so they take no part in the
+  loss, the probabilities or generation.
+  """
+  return (vocab_size + 7) // 8 * 8
+
+
+class PTBInput(object):
+  """The input data."""
+
+  def __init__(self, config, data, name=None):
+    self.batch_size = batch_size = config.batch_size
+    self.num_steps = num_steps = config.num_steps
+    self.epoch_size = ((len(data) // batch_size) - 1) // num_steps
+    self.input_data, self.targets = reader.ptb_producer(
+        data, batch_size, num_steps, name=name)
+
+
 class PTBModel(object):
   """The PTB model."""
 
-  def __init__(self, is_training, config):
+  def __init__(self, is_training, config, input_=None):
     self.batch_size = batch_size = config.batch_size
     self.num_steps = num_steps = config.num_steps
     size = config.hidden_size
-    vocab_size = config.vocab_size
-
-    self._input_data = tf.placeholder(tf.int32, [batch_size, num_steps])
-    self._targets = tf.placeholder(tf.int32, [batch_size, num_steps])
-    self._weights = tf.placeholder(tf.float32, [batch_size * num_steps])
+    vocab_size = padded_vocab_size(config.vocab_size)
+
+    # Without an input pipeline (e.g. when generating) the words are fed.
+    self._input = input_
+    if input_ is None:
+      self._input_data = tf.placeholder(tf.int32, [batch_size, num_steps])
+      self._targets = tf.placeholder(tf.int32, [batch_size, num_steps])
+    else:
+      self._input_data = input_.input_data
+      self._targets = input_.targets
+    # Every target counts equally unless per-token weights are fed.
+    self._weights = tf.placeholder_with_default(
+        tf.ones([batch_size * num_steps]), [batch_size * num_steps])
 
     # Slightly better results can be obtained with forget gate biases
     # initialized to 1 but the hyperparameters of the model would need to be
     # different than reported in the paper.
-    lstm_cell = tf.nn.rnn_cell.BasicLSTMCell(size, forget_bias=0.0)
+    # LSTMBlockCell computes all four gates of a step in a single fused
+    # kernel instead of the handful of small ops BasicLSTMCell emits.
+    lstm_cell = tf.contrib.rnn.LSTMBlockCell(size, forget_bias=0.0)
     if is_training and config.keep_prob < 1:
       lstm_cell = tf.nn.rnn_cell.DropoutWrapper(
           lstm_cell, output_keep_prob=config.keep_prob)
     cell = tf.nn.rnn_cell.MultiRNNCell([lstm_cell] * config.num_layers)
 
-    self._initial_state = cell.zero_state(batch_size, tf.float32)
-
-    with tf.device("/cpu:0"):
-      embedding = tf.get_variable("embedding", [vocab_size, size])
-      inputs = tf.nn.embedding_lookup(embedding, self._input_data)
+    # The state carried between minibatches lives in a local variable, so it
+    # stays on the device instead of being fetched and fed back every step.
+    # It is not checkpointed and is reset at the start of each epoch.
+    zero_state = cell.zero_state(batch_size, tf.float32)
+    self._initial_state = tf.Variable(
+        zero_state, trainable=False, name="state",
+        collections=[tf.GraphKeys.LOCAL_VARIABLES])
+    self._reset_state = tf.group(tf.assign(self._initial_state, zero_state))
+
+    # The embedding doubles as the softmax weights, and the full projection
+    # reads the whole table every step, so it lives on the same device as the
+    # RNN rather than in host memory.
+    embedding = tf.get_variable("embedding", [vocab_size, size])
+    inputs = tf.nn.embedding_lookup(embedding, self._input_data)
 
     if is_training and config.keep_prob < 1:
       inputs = tf.nn.dropout(inputs, config.keep_prob)
 
-    # Simplified version of tensorflow.models.rnn.rnn.py's rnn().
-    # This builds an unrolled LSTM for tutorial purposes only.
-    # In general, use the rnn() or state_saving_rnn() from rnn.py.
-    #
-    # The alternative version of the code below is:
-    #
-    # from tensorflow.models.rnn import rnn
-    # inputs = [tf.squeeze(input_, [1])
-    #           for input_ in tf.split(1, num_steps, inputs)]
-    # outputs, state = rnn.rnn(cell, inputs, initial_state=self._initial_state)
-    outputs = []
-    state = self._initial_state
-    with tf.variable_scope("RNN"):
-      for time_step in range(num_steps):
-        if time_step > 0: tf.get_variable_scope().reuse_variables()
-        (cell_output, state) = cell(inputs[:, time_step, :], state)
-        outputs.append(cell_output)
-
-    output = tf.reshape(tf.concat(1, outputs), [-1, size])
-    softmax_w = tf.get_variable("softmax_w", [size, vocab_size])
+    # dynamic_rnn runs the cell inside a tf.while_loop, so the graph holds a
+    # single copy of the cell no matter how many steps are unrolled.
+    outputs, state = tf.nn.dynamic_rnn(
+        cell, inputs, initial_state=self._initial_state.value(), scope="RNN")
+
+    output = tf.reshape(outputs, [-1, size])
+    # The softmax weights are tied to the embedding, which halves the
+    # parameters and weight gradients of the input and output layers.
     softmax_b = tf.get_variable("softmax_b", [vocab_size])
-    logits = tf.matmul(output, softmax_w) + softmax_b
-    loss = tf.nn.seq2seq.sequence_loss_by_example(
-        [logits],
-        [tf.reshape(self._targets, [-1])],
-        [self._weights])
+    targets = tf.reshape(self._targets, [-1])
+    self._sampled_softmax = (
+        is_training and 0 < config.num_sampled < config.vocab_size)
+    if self._sampled_softmax:
+      # Training only needs the loss, so score each target against a sample
+      # of the vocabulary instead of projecting onto all of it.
+      logits = None
+      loss = tf.nn.sampled_softmax_loss(
+          weights=embedding, biases=softmax_b, inputs=output,
+          labels=tf.expand_dims(tf.cast(targets, tf.int64), 1),
+          num_sampled=config.num_sampled, num_classes=config.vocab_size)
+    else:
+      # The vocab projection is the largest GEMM in the model. Run it in
+      # data_type() against 32-bit master weights and hand 32-bit logits to
+      # the loss so the reduction stays accurate.
+      logits = (tf.matmul(tf.cast(output, data_type()),
+                          tf.cast(embedding, data_type()), transpose_b=True) +
+                tf.cast(softmax_b, data_type()))
+      logits = tf.cast(logits, tf.float32)
+      # Drop the padding columns so they stay out of the softmax normalizer.
+      logits = tf.slice(logits, [0, 0], [-1, config.vocab_size])
+      loss = tf.nn.sparse_softmax_cross_entropy_with_logits(logits, targets)
+    loss *= self._weights
     self._cost = cost = tf.reduce_sum(loss) / batch_size
     self._final_state = state
     self._logits = logits
-    self._probs = tf.nn.softmax(logits)
+    # Training never reads the normalized distribution, so only inference
+    # models pay for the extra softmax over the vocabulary.
+    self._probs = None if is_training else tf.nn.softmax(logits)
+    # Draw the next word in the graph so generation only has to fetch its id.
+    self._sample = None if is_training else tf.multinomial(logits, 1)
     self.saver = tf.train.Saver(tf.all_variables())
 
     if not is_training:
+      self._update_state = tf.group(tf.assign(self._initial_state, state))
       return
 
     self._lr = tf.Variable(0.0, trainable=False)
+    self._new_lr = tf.placeholder(tf.float32, [], name="new_learning_rate")
+    self._lr_update = tf.assign(self._lr, self._new_lr)
     tvars = tf.trainable_variables()
-    grads, _ = tf.clip_by_global_norm(tf.gradients(cost, tvars),
-                                      config.max_grad_norm)
+    # On the sampled-softmax path both uses of the embedding are gathers, so
+    # its gradient stays IndexedSlices through clip_by_global_norm and
+    # GradientDescentOptimizer and only those rows are touched. The full
+    # projection adds a dense [vocab, hidden] gradient, which densifies the
+    # whole update. Colocating each gradient with its forward op keeps the
+    # backward pass on the device that owns the weights.
+    grads, _ = tf.clip_by_global_norm(
+        tf.gradients(cost, tvars, colocate_gradients_with_ops=True),
+        config.max_grad_norm)
     optimizer = tf.train.GradientDescentOptimizer(self.lr)
-    self._train_op = optimizer.apply_gradients(zip(grads, tvars))
+    # The backward pass still reads the old state, so only carry the new one
+    # forward once the update has been applied.
+    apply_op = optimizer.apply_gradients(zip(grads, tvars))
+    with tf.control_dependencies([apply_op]):
+      self._train_op = tf.group(tf.assign(self._initial_state, state))
 
   def assign_lr(self, session, lr_value):
-    session.run(tf.assign(self.lr, lr_value))
+    session.run(self._lr_update, feed_dict={self._new_lr: lr_value})
+
+  @property
+  def input(self):
+    return self._input
 
   @property
   def input_data(self):
@@ -168,6 +257,14 @@ class PTBModel(object):
   def probs(self):
     return self._probs
 
+  @property
+  def sample(self):
+    return self._sample
+
+  @property
+  def sampled_softmax(self):
+    return self._sampled_softmax
+
   @property
   def logits(self):
     return self._logits
@@ -188,6 +285,14 @@ class PTBModel(object):
   def final_state(self):
     return self._final_state
 
+  @property
+  def reset_state(self):
+    return self._reset_state
+
+  @property
+  def update_state(self):
+    return self._update_state
+
   @property
   def lr(self):
     return self._lr
@@ -211,6 +316,7 @@ class SmallConfig(object):
   lr_decay = 0.5
   batch_size = 20
   vocab_size = 10000
+  num_sampled = 512
 
 
 class MediumConfig(object):
@@ -227,6 +333,7 @@ class MediumConfig(object):
   lr_decay = 0.8
   batch_size = 20
   vocab_size = 10000
+  num_sampled = 512
 
 
 class LargeConfig(object):
@@ -243,6 +350,7 @@ class LargeConfig(object):
   lr_decay = 1 / 1.15
   batch_size = 20
   vocab_size = 10000
+  num_sampled = 512
 
 
 class TestConfig(object):
@@ -259,30 +367,37 @@ class TestConfig(object):
   lr_decay = 0.5
   batch_size = 10
   vocab_size = 100
+  num_sampled = 64
 
 
-def run_epoch(session, m, data, eval_op, verbose=False):
-  """Runs the model on the given data."""
-  epoch_size = ((len(data) // m.batch_size) - 1) // m.num_steps
+def run_epoch(session, m, eval_op, verbose=False):
+  """Runs the model on one epoch of its input data.
+
+  Returns the perplexity, or the average per-word loss for a model trained with
+  the sampled softmax, whose cost does not give a perplexity.
+  """
+  metric = "sampled loss" if m.sampled_softmax else "perplexity"
+  epoch_size = m.input.epoch_size
   start_time = time.time()
   costs = 0.0
   iters = 0
-  state = m.initial_state.eval()
-  for step, (x, y) in enumerate(reader.ptb_iterator(data, m.batch_size,
-                                                    m.num_steps)):
-    cost, state, logits, probs, _ = session.run([m.cost, m.final_state, m.logits, m.probs, eval_op],
-                                 {m.input_data: x,
-                                  m.targets: y,
-                                  m.initial_state: state,
-                                  m.weights: np.ones(m.batch_size * m.num_steps)})
+  session.run(m.reset_state)
+  for step in range(epoch_size):
+    cost, _ = session.run([m.cost, eval_op])
     costs += cost
     iters += m.num_steps
 
     if verbose and step % (epoch_size // 10) == 10:
-      print("%.3f perplexity: %.3f speed: %.0f wps" %
-            (step * 1.0 / epoch_size, np.exp(costs / iters),
+      print("%.3f %s: %.3f speed: %.0f wps" %
+            (step * 1.0 / epoch_size, metric, epoch_result(m, costs, iters),
              iters * m.batch_size / (time.time() - start_time)))
 
+  return epoch_result(m, costs, iters)
+
+
+def epoch_result(m, costs, iters):
+  if m.sampled_softmax:
+    return costs / iters
   return np.exp(costs / iters)
 
 
@@ -334,29 +449,41 @@ def train():
   with tf.Graph().as_default(), tf.Session() as session:
     initializer = tf.random_uniform_initializer(-config.init_scale,
                                                 config.init_scale)
+    train_input = PTBInput(config=config, data=train_data, name="TrainInput")
+    valid_input = PTBInput(config=config, data=valid_data, name="ValidInput")
+    test_input = PTBInput(config=eval_config, data=test_data, name="TestInput")
     with tf.variable_scope("model", reuse=None, initializer=initializer):
-      m = PTBModel(is_training=True, config=config)
+      m = PTBModel(is_training=True, config=config, input_=train_input)
     with tf.variable_scope("model", reuse=True, initializer=initializer):
-      mvalid = PTBModel(is_training=False, config=config)
-      mtest = PTBModel(is_training=False, config=eval_config)
+      mvalid = PTBModel(is_training=False, config=config, input_=valid_input)
+      mtest = PTBModel(is_training=False, config=eval_config,
+                       input_=test_input)
 
     tf.initialize_all_variables().run()
+    tf.initialize_local_variables().run()
+    coord = tf.train.Coordinator()
+    threads = tf.train.start_queue_runners(sess=session, coord=coord)
 
     for i in range(config.max_max_epoch):
       lr_decay = config.lr_decay ** max(i - config.max_epoch, 0.0)
       m.assign_lr(session, config.learning_rate * lr_decay)
 
       print("Epoch: %d Learning rate: %.3f" % (i + 1, session.run(m.lr)))
-      train_perplexity = run_epoch(session, m, train_data, m.train_op,
-                                   verbose=True)
-      print("Epoch: %d Train Perplexity: %.3f" % (i + 1, train_perplexity))
-      valid_perplexity = run_epoch(session, mvalid, valid_data, tf.no_op())
+      train_result = run_epoch(session, m, m.train_op, verbose=True)
+      if m.sampled_softmax:
+        print("Epoch: %d Train Sampled Loss: %.3f" % (i + 1, train_result))
+      else:
+        print("Epoch: %d Train Perplexity: %.3f" % (i + 1, train_result))
+      valid_perplexity = run_epoch(session, mvalid, mvalid.update_state)
       print("Epoch: %d Valid Perplexity: %.3f" % (i + 1, valid_perplexity))
       m.saver.save(session, os.path.join(FLAGS.model_path_prefix, "ptb.ckpt"))
 
-    test_perplexity = run_epoch(session, mtest, test_data, tf.no_op())
+    test_perplexity = run_epoch(session, mtest, mtest.update_state)
     print("Test Perplexity: %.3f" % test_perplexity)
 
+    coord.request_stop()
+    coord.join(threads)
+
 def generate(word_to_id, id_to_word):
 
   config = get_config()
@@ -372,25 +499,19 @@ def generate(word_to_id, id_to_word):
       f = open(os.path.join(FLAGS.model_path_prefix, "ptb.ckpt"), "r")
       m.saver.restore(session, os.path.join(FLAGS.model_path_prefix, "ptb.ckpt"))
 
-      probs, final_state, _ = session.run([m.probs, m.final_state, tf.no_op()],
-                                                {m.input_data: np.zeros((1, 1)),
-                                                 m.targets: np.zeros((1, 1)),
-                                                 m.initial_state: m.initial_state.eval(),
-                                                 m.weights: np.ones(1)})
+      tf.initialize_local_variables().run()
+      # Reuse one int32 buffer for the fed word instead of converting a new
+      # nested list every step.
+      word = np.zeros((1, 1), dtype=np.int32)
+      session.run(m.update_state, {m.input_data: word})
       next_word = int(word_to_id["<eos>"])
       sentence = []
       count = 0
       while True:
-          probs, final_state, _ = session.run([m.probs, m.final_state, tf.no_op()],
-                                                    {m.input_data: [[next_word]],
-                                                     m.targets: np.zeros((1, 1)),
-                                                     m.initial_state: final_state,
-                                                     m.weights: np.ones(1)})
-          # Saw some precision errors (w 1e-6 p didn't sum to 1)
-          # So renormalize:
-          p = np.array(probs[0])
-          p /= p.sum().astype(np.float64)
-          next_word = non_uniform_randomly_sample(p)
+          word[0, 0] = next_word
+          sample, _ = session.run([m.sample, m.update_state],
+                                  {m.input_data: word})
+          next_word = int(sample[0, 0])
           sentence += [token_to_string(id_to_word[str(next_word)])]
           count += 1
           if count > 1000:
@@ -419,18 +540,6 @@ def token_to_string(token):
 
     return token
 
-def non_uniform_randomly_sample(p):
-
-  rn = random.random()
-  cnt=0.0
-  for i in range(len(p)):
-    cnt+=p[i]
-    if rn <= cnt:
-      return i
-
-  # in cases where sum(p) is close but not equal to zero, we may walk through the whole vector ... in this case, just compromise and take the element that had the largest probability
-  return np.argmax(p)
-
 if __name__ == "__main__":
   tf.app.run()
 
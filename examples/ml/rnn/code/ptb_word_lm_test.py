@@ -0,0 +1,107 @@
+# Copyright 2015 The TensorFlow Authors. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+
+"""Tests for the PTB LSTM model in ptb_word_lm."""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import numpy as np
+import tensorflow as tf
+
+import ptb_word_lm
+
+
+class PtbWordLmTest(tf.test.TestCase):
+
+  def setUp(self):
+    self._vocab_size = 20
+    self._raw_data = [i % self._vocab_size for i in range(100)]
+
+  def _config(self, num_sampled, batch_size=None, num_steps=None):
+    config = ptb_word_lm.TestConfig()
+    config.vocab_size = self._vocab_size
+    config.num_sampled = num_sampled
+    if batch_size is not None:
+      config.batch_size = batch_size
+    if num_steps is not None:
+      config.num_steps = num_steps
+    return config
+
+  def _runModels(self, num_sampled):
+    config = self._config(num_sampled)
+    eval_config = self._config(num_sampled, batch_size=1, num_steps=1)
+    with tf.Graph().as_default() as graph:
+      initializer = tf.random_uniform_initializer(-config.init_scale,
+                                                  config.init_scale)
+      train_input = ptb_word_lm.PTBInput(config=config, data=self._raw_data,
+                                         name="TrainInput")
+      with tf.variable_scope("model", reuse=None, initializer=initializer):
+        m = ptb_word_lm.PTBModel(is_training=True, config=config,
+                                 input_=train_input)
+      with tf.variable_scope("model", reuse=True, initializer=initializer):
+        mgen = ptb_word_lm.PTBModel(is_training=False, config=eval_config)
+
+      self.assertEqual(m.sampled_softmax, num_sampled > 0)
+      self.assertFalse(mgen.sampled_softmax)
+      embedding = [v for v in tf.trainable_variables()
+                   if v.name == "model/embedding:0"]
+      self.assertEqual(len(embedding), 1)
+      self.assertEqual(embedding[0].get_shape().as_list(), [24, 2])
+
+      with self.test_session(graph=graph) as session:
+        tf.initialize_all_variables().run()
+        tf.initialize_local_variables().run()
+        coord = tf.train.Coordinator()
+        threads = tf.train.start_queue_runners(session, coord=coord)
+        try:
+          m.assign_lr(session, config.learning_rate)
+          zero_state = session.run(m.initial_state)
+          self.assertAllEqual(zero_state, np.zeros_like(zero_state))
+
+          cost, _ = session.run([m.cost, m.train_op])
+          self.assertTrue(np.isfinite(cost))
+          self.assertGreater(np.abs(session.run(m.initial_state)).sum(), 0)
+
+          session.run(m.reset_state)
+          self.assertAllEqual(session.run(m.initial_state), zero_state)
+
+          probs, sample, _ = session.run(
+              [mgen.probs, mgen.sample, mgen.update_state],
+              {mgen.input_data: [[3]]})
+          # The padded ids are sliced off before the softmax and the draw.
+          self.assertEqual(probs.shape, (1, self._vocab_size))
+          self.assertNear(probs.sum(), 1.0, 1e-5)
+          self.assertTrue(0 <= sample[0, 0] < self._vocab_size)
+          self.assertGreater(np.abs(session.run(mgen.initial_state)).sum(), 0)
+        finally:
+          coord.request_stop()
+          coord.join(threads)
+
+  def testPaddedVocabSize(self):
+    self.assertEqual(ptb_word_lm.padded_vocab_size(1), 8)
+    self.assertEqual(ptb_word_lm.padded_vocab_size(100), 104)
+    self.assertEqual(ptb_word_lm.padded_vocab_size(10000), 10000)
+
+  def testFullSoftmax(self):
+    self._runModels(num_sampled=0)
+
+  def testSampledSoftmax(self):
+    self._runModels(num_sampled=5)
+
+
+if __name__ == "__main__":
+  tf.test.main()
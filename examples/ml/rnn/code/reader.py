@@ -114,3 +114,43 @@ def ptb_iterator(raw_data, batch_size, num_steps):
     x = data[:, i*num_steps:(i+1)*num_steps]
     y = data[:, i*num_steps+1:(i+1)*num_steps+1]
     yield (x, y)
+
+
+def ptb_producer(raw_data, batch_size, num_steps, name=None):
+  """Iterate on the raw PTB data inside the graph.
+
+  This chunks up raw_data into batches of examples and returns Tensors that
+  are drawn from these batches, so the training loop does not have to feed
+  every minibatch through feed_dict.
+
+  Args:
+    raw_data: one of the raw data outputs from ptb_raw_data.
+    batch_size: int, the batch size.
+    num_steps: int, the number of unrolls.
+    name: the name of this operation (optional).
+
+  Returns:
+    A pair of Tensors, each shaped [batch_size, num_steps]. The second element
+    of the tuple is the same data time-shifted to the right by one.
+
+  Raises:
+    ValueError: if batch_size or num_steps are too high.
+  """
+  with tf.name_scope(name or "PTBProducer"):
+    raw_data = np.array(raw_data, dtype=np.int32)
+
+    data_len = len(raw_data)
+    batch_len = data_len // batch_size
+    data = np.reshape(raw_data[:batch_size * batch_len],
+                      [batch_size, batch_len])
+
+    epoch_size = (batch_len - 1) // num_steps
+
+    if epoch_size == 0:
+      raise ValueError("epoch_size == 0, decrease batch_size or num_steps")
+
+    data = tf.constant(data, name="data")
+    i = tf.train.range_input_producer(epoch_size, shuffle=False).dequeue()
+    x = tf.slice(data, tf.pack([0, i * num_steps]), [batch_size, num_steps])
+    y = tf.slice(data, tf.pack([0, i * num_steps + 1]), [batch_size, num_steps])
+    return x, y